@@ -1,77 +1,250 @@
 import argparse
-import json
+import asyncio
+import os
 import random
+import sys
 import time
-import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Any
+import aiohttp
+import numpy as np
+import orjson
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, BinaryIO
 
-def send_request(url: str, prompt: str, request_id: int, max_tokens: int = 128, temperature: float = 0.7) -> Dict[str, Any]:
-    """发送单个请求到LLM服务器"""
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+_tiktoken_enc = None
+_tiktoken_failed = False
+
+def _get_tiktoken_encoder():
+    """首次需要时再加载tiktoken编码器；BPE文件未缓存时会联网下载，离线失败则退回简单分词"""
+    global _tiktoken_enc, _tiktoken_failed
+    if _tiktoken_enc is None and tiktoken is not None and not _tiktoken_failed:
+        try:
+            _tiktoken_enc = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _tiktoken_failed = True  # 只尝试一次
+    return _tiktoken_enc
+
+
+def count_tokens(usage_tokens: Optional[int], content: str, num_choices: int = 1) -> int:
+    """优先使用服务端返回的usage.completion_tokens，否则用tiktoken估算
+
+    usage统计的是整个响应的token数，批量请求(n>1)时无法拆分到单个choice，只能逐个估算。
+    """
+    if usage_tokens is not None and num_choices == 1:
+        return usage_tokens
+    enc = _get_tiktoken_encoder()
+    if enc is not None:
+        return len(enc.encode(content))
+    return len(content.split())  # 简单分词估算token数
+
+_PROMPT_PLACEHOLDER = b'"__PROMPT__"'
+# 请求体以bytes发送，需显式声明类型；外部传入的session未必带有该默认头
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+@lru_cache(maxsize=None)
+def _payload_template(max_tokens: int, temperature: float, n: int) -> bytes:
+    """预先序列化请求体，只留下prompt占位符，避免每个请求重复构造dict和JSON编码"""
     payload = {
         "model": "Qwen3-1.7B-Q8_0",
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": [{"role": "user", "content": "__PROMPT__"}],
         "temperature": temperature,
         "max_tokens": max_tokens,
         "stream": False
     }
-    headers = {"Content-Type": "application/json"}
-    
+    if n > 1:
+        payload["n"] = n
+    return orjson.dumps(payload)
+
+async def send_request(session: aiohttp.ClientSession, url: str, prompt: str, request_ids: List[int], submit_time: Optional[float] = None, max_tokens: int = 128, temperature: float = 0.7) -> List[Dict[str, Any]]:
+    """发送请求到LLM服务器，len(request_ids) > 1 时通过 n 参数合并为一次调用
+
+    submit_time为请求的预定到达时刻(perf_counter，不限速时为入队时刻)，与complete_time一起记录到结果中，
+    用于分析到达间隔和排队等待; latency只统计实际HTTP往返时间。
+    """
+    body = _payload_template(max_tokens, temperature, len(request_ids)).replace(
+        _PROMPT_PLACEHOLDER, orjson.dumps(prompt))
     start_time = time.perf_counter()
+    if submit_time is None:
+        submit_time = start_time
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=60)
-        if response.status_code == 200:
-            data = response.json()
-            latency = time.perf_counter() - start_time
-            content = data["choices"][0]["message"]["content"]
-            tokens = len(content.split())  # 简单分词估算token数
-            return {
-                "success": True,
-                "latency": latency,
-                "tokens": tokens,
-                "request_id": request_id
-            }
-        else:
-            return {
+        async with session.post(url, data=body, headers=_JSON_HEADERS,
+                                timeout=aiohttp.ClientTimeout(total=60)) as response:
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+                complete_time = time.perf_counter()
+                latency = complete_time - start_time
+                # 只保留需要的字段，尽早释放整个响应对象
+                contents = [choice["message"]["content"] for choice in data["choices"]]
+                usage_tokens = (data.get("usage") or {}).get("completion_tokens")
+                del data
+                if len(contents) < len(request_ids):
+                    raise ValueError(f"expected {len(request_ids)} choices, got {len(contents)}")
+                # 一次往返的延迟由批内所有请求共享
+                return [
+                    {
+                        "success": True,
+                        "latency": latency,
+                        "tokens": count_tokens(usage_tokens, content, len(request_ids)),
+                        "request_id": request_id,
+                        "submit_time": submit_time,
+                        "complete_time": complete_time
+                    }
+                    for request_id, content in zip(request_ids, contents)
+                ]
+            else:
+                error = (await response.text())[:200]
+                complete_time = time.perf_counter()
+                return [
+                    {
+                        "success": False,
+                        "status": response.status,
+                        "error": error,
+                        "request_id": request_id,
+                        "submit_time": submit_time,
+                        "complete_time": complete_time
+                    }
+                    for request_id in request_ids
+                ]
+    except Exception as e:
+        complete_time = time.perf_counter()
+        return [
+            {
                 "success": False,
-                "status": response.status_code,
-                "error": response.text[:200] if response.text else "",
-                "request_id": request_id
+                "error": str(e),
+                "request_id": request_id,
+                "submit_time": submit_time,
+                "complete_time": complete_time
             }
-    except Exception as e:
-        return {
-            "success": False,
-            "error": str(e),
-            "request_id": request_id
-        }
+            for request_id in request_ids
+        ]
+
+def create_session(max_workers: int = 10) -> aiohttp.ClientSession:
+    """创建共享连接池的会话，需在事件循环内调用
 
-def parallel_execute_requests(
+    连接数上限为max_workers，超过时请求在连接池中排队等待;
+    keep-alive复用TCP/TLS连接，避免每个请求重新握手。
+    aiohttp在建立客户端连接时已默认设置TCP_NODELAY，小请求体不会被Nagle算法延迟。
+    """
+    connector = aiohttp.TCPConnector(limit=max_workers, limit_per_host=max_workers, keepalive_timeout=60)
+    headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+    return aiohttp.ClientSession(connector=connector, headers=headers)
+
+async def parallel_execute_requests(
     url: str,
     prompt: str,
     total_requests: int,
     max_workers: int = 10,
-    jitter: float = 0.0
+    qps: float = 0.0,
+    batch_size: int = 1,
+    session: Optional[aiohttp.ClientSession] = None,
+    output_fp: Optional[BinaryIO] = None
 ) -> List[Dict[str, Any]]:
-    """并行执行多个请求"""
-    results = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for i in range(total_requests):
-            # 创建任务并添加jitter
-            futures.append(executor.submit(send_request, url, prompt, i))
-            if jitter > 0.0:
-                time.sleep(jitter * random.random())
-        
-        # 按完成顺序收集结果
-        for i, future in enumerate(as_completed(futures)):
-            result = future.result()
-            results.append(result)
-            if (i + 1) % 10 == 0 or i == total_requests - 1:
-                print(f"已完成 {i+1}/{total_requests} 请求 | 成功率: {len([r for r in results if r['success']]) / (i+1):.1%}")
-    
+    """并行执行多个请求（max_workers个消费者协程从有界队列取任务，每batch_size个请求合并为一次调用）
+
+    队列长度限制为2*max_workers，生产者在队列满时等待，待发送的任务数不会超过该上限
+    (已完成的结果仍全部保存在results中，直到生成报告);
+    设置qps时submit_time为预定到达时刻，不受队列阻塞影响。
+    传入session可在多轮压测间复用已建立的连接，否则内部创建并在结束时关闭。
+    传入output_fp时每个结果完成后立即以NDJSON格式写入，无需在结束时一次性序列化。
+    """
+    if max_workers < 1:
+        raise ValueError("max_workers must be greater than 0")
+    if batch_size < 1:
+        raise ValueError("batch_size must be greater than 0")
+    results = [None] * total_requests
+    queue = asyncio.Queue(maxsize=2 * max_workers)
+    done_count = 0
+    success_count = 0
+
+    async def producer():
+        # 按泊松过程预定到达时刻：间隔服从指数分布，平均速率为qps。
+        # 到达时刻是绝对的，队列满导致put()阻塞时不会推迟后续到达，
+        # 记录的submit_time是预定时刻，背压表现为排队等待时间
+        arrival_time = time.perf_counter()
+        for i in range(0, total_requests, batch_size):
+            request_ids = list(range(i, min(i + batch_size, total_requests)))
+            if qps > 0.0:
+                delay = arrival_time - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                submit_time = arrival_time
+                arrival_time += random.expovariate(qps / len(request_ids))
+            else:
+                submit_time = time.perf_counter()
+            await queue.put((request_ids, submit_time))
+        # 每个消费者一个哨兵，通知其退出
+        for _ in range(max_workers):
+            await queue.put(None)
+
+    async def consumer():
+        nonlocal done_count, success_count
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            request_ids, submit_time = item
+            batch_results = await send_request(session, url, prompt, request_ids, submit_time)
+            # 按request_id写入，保持提交顺序；计数器避免每次重新扫描结果列表
+            for result in batch_results:
+                results[result["request_id"]] = result
+                if output_fp is not None:
+                    output_fp.write(orjson.dumps(result) + b"\n")
+                done_count += 1
+                success_count += int(result["success"])
+                if done_count % 10 == 0 or done_count == total_requests:
+                    print(f"已完成 {done_count}/{total_requests} 请求 | 成功率: {success_count / done_count:.1%}")
+
+    # 所有请求共享同一个连接池
+    owns_session = session is None
+    if owns_session:
+        session = create_session(max_workers)
+    try:
+        # 哨兵负责让消费者退出；任一协程出错时取消其余协程并把异常抛给调用方，避免永久阻塞
+        tasks = [asyncio.ensure_future(producer())]
+        tasks += [asyncio.ensure_future(consumer()) for _ in range(max_workers)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    finally:
+        if owns_session:
+            await session.close()
+
     return results
 
-def generate_report(results: List[Dict[str, Any]], config: Dict[str, Any]) -> Dict[str, Any]:
+LATENCY_HISTOGRAM_BINS = 20
+
+def _sorted_percentiles(sorted_values: np.ndarray, percentiles: List[float]) -> np.ndarray:
+    """在已排序数组上按下标插值取百分位，结果与np.percentile默认的linear方法一致"""
+    positions = np.asarray(percentiles, dtype=np.float64) / 100 * (len(sorted_values) - 1)
+    return np.interp(positions, np.arange(len(sorted_values)), sorted_values)
+
+def _sorted_log_histogram(sorted_values: np.ndarray, num_bins: int):
+    """在已排序数组上用二分查找统计对数分桶直方图，区间划分与np.histogram一致"""
+    lo, hi = sorted_values[0], sorted_values[-1]
+    if hi > lo:
+        edges = np.logspace(np.log10(lo), np.log10(hi), num_bins + 1)
+        edges[0], edges[-1] = lo, hi  # 消除浮点误差，确保最值落在桶内
+    else:
+        edges = np.array([lo, hi], dtype=np.float64)
+    bounds = np.searchsorted(sorted_values, edges, side="left")
+    bounds[-1] = len(sorted_values)  # 最后一个桶包含右端点
+    return np.diff(bounds), edges
+
+def generate_report(results: List[Dict[str, Any]], config: Dict[str, Any], total_time: float) -> Dict[str, Any]:
     """生成压测报告"""
     successful = [r for r in results if r["success"]]
     failed = len(results) - len(successful)
@@ -81,24 +254,59 @@ def generate_report(results: List[Dict[str, Any]], config: Dict[str, Any]) -> Di
         "summary": {
             "total_requests": len(results),
             "concurrency": config["max_workers"],
-            "jitter": config["jitter"],
+            "qps": config["qps"],
             "success_rate": len(successful) / len(results) if results else 0,
-            "failed": failed
+            "failed": failed,
+            "total_time": total_time,
+            "throughput": len(results) / total_time
         }
     }
     
     if successful:
-        latencies = [r["latency"] for r in successful]
-        tokens_list = [r["tokens"] for r in successful]
+        n = len(successful)
+        # 按提交时间排序，抖动反映相邻到达请求之间的延迟变化
+        successful.sort(key=lambda r: r["submit_time"])
+        latencies = np.fromiter((r["latency"] for r in successful), dtype=np.float64, count=n)
+        submit_times = np.fromiter((r["submit_time"] for r in successful), dtype=np.float64, count=n)
+        tokens_list = np.fromiter((r["tokens"] for r in successful), dtype=np.int64, count=n)
+        # 排序一次，最值、百分位和直方图都直接在有序数组上取；抖动仍按提交顺序计算
+        sorted_latencies = np.sort(latencies)
+        p50, p90, p95, p99, p999 = _sorted_percentiles(sorted_latencies, [50, 90, 95, 99, 99.9])
         
-        report["summary"]["avg_latency"] = sum(latencies) / len(latencies)
-        report["summary"]["min_latency"] = min(latencies)
-        report["summary"]["max_latency"] = max(latencies)
+        report["summary"].update({
+            "avg_latency": float(latencies.mean()),
+            "min_latency": float(sorted_latencies[0]),
+            "max_latency": float(sorted_latencies[-1]),
+            "p50_latency": float(p50),
+            "p90_latency": float(p90),
+            "p95_latency": float(p95),
+            "p99_latency": float(p99),
+            "p99.9_latency": float(p999),
+            # 相邻请求延迟差的平均绝对值
+            "latency_jitter": float(np.abs(np.diff(latencies)).mean()) if n > 1 else 0.0,
+            "avg_inter_arrival": float(np.diff(submit_times).mean()) if n > 1 else 0.0
+        })
         
-        total_tokens = sum(tokens_list)
-        report["summary"]["total_tokens"] = total_tokens
-        report["summary"]["avg_tokens_per_request"] = total_tokens / len(successful)
-        report["summary"]["tokens_per_second"] = total_tokens / (report["summary"]["avg_latency"] * config["max_workers"])
+        # 对数分桶的延迟直方图，长尾部分也能保留足够分辨率
+        counts, edges = _sorted_log_histogram(sorted_latencies, LATENCY_HISTOGRAM_BINS)
+        report["latency_histogram"] = {
+            "bin_edges": edges.tolist(),
+            "counts": counts.tolist()
+        }
+        
+        sorted_tokens = np.sort(tokens_list)
+        total_tokens = int(sorted_tokens.sum())
+        t50, t95, t99 = _sorted_percentiles(sorted_tokens, [50, 95, 99])
+        report["summary"].update({
+            "total_tokens": total_tokens,
+            "avg_tokens_per_request": total_tokens / n,
+            "min_tokens": int(sorted_tokens[0]),
+            "max_tokens": int(sorted_tokens[-1]),
+            "p50_tokens": float(t50),
+            "p95_tokens": float(t95),
+            "p99_tokens": float(t99),
+            "tokens_per_second": total_tokens / total_time
+        })
     
     # 错误分析
     if failed > 0:
@@ -112,6 +320,19 @@ def generate_report(results: List[Dict[str, Any]], config: Dict[str, Any]) -> Di
     
     return report
 
+def run_event_loop(coro):
+    """运行协程，有uvloop时使用其事件循环
+
+    优先uvloop.run / loop_factory，旧版本才退回已弃用的事件循环策略接口uvloop.install()。
+    """
+    if uvloop is not None:
+        if hasattr(uvloop, "run"):
+            return uvloop.run(coro)
+        if sys.version_info >= (3, 12):
+            return asyncio.run(coro, loop_factory=uvloop.new_event_loop)
+        uvloop.install()
+    return asyncio.run(coro)
+
 def main():
     parser = argparse.ArgumentParser(description="LLM服务器压力测试工具")
     parser.add_argument("--url", default="http://localhost:8080/v1/chat/completions", 
@@ -121,26 +342,40 @@ def main():
     parser.add_argument("--requests", type=int, default=100, 
                         help="总请求数")
     parser.add_argument("--concurrency", type=int, default=10, 
-                        help="并发工作线程数")
-    parser.add_argument("--jitter", type=float, default=0.0, 
-                        help="请求间隔抖动系数 (0.0-1.0)")
+                        help="最大并发请求数")
+    parser.add_argument("--qps", type=float, default=0.0, 
+                        help="目标请求速率 (泊松到达)，0表示不限速")
+    parser.add_argument("--batch-size", type=int, default=1, 
+                        help="每次调用合并的请求数 (通过OpenAI兼容的n参数)")
     parser.add_argument("--output", default="stress_test_report.json", 
                         help="输出报告文件名")
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency 必须大于等于1")
+    if args.batch_size < 1:
+        parser.error("--batch-size 必须大于等于1")
     
-    print(f"开始压力测试: {args.requests} 请求, {args.concurrency} 并发, jitter={args.jitter}")
+    print(f"开始压力测试: {args.requests} 请求, {args.concurrency} 并发, qps={args.qps or '不限'}, batch_size={args.batch_size}")
     print(f"提示词: '{args.prompt[:50]}{'...' if len(args.prompt) > 50 else ''}'")
     
+    output_stem = os.path.splitext(args.output)[0]
+    results_path = output_stem + ".ndjson"
+    # --output本身以.ndjson结尾时改名，避免汇总报告覆盖单请求结果
+    if os.path.abspath(results_path) == os.path.abspath(args.output):
+        results_path = output_stem + ".results.ndjson"
     start_time = time.perf_counter()
     
-    # 执行压测
-    results = parallel_execute_requests(
-        url=args.url,
-        prompt=args.prompt,
-        total_requests=args.requests,
-        max_workers=args.concurrency,
-        jitter=args.jitter
-    )
+    # 执行压测，有uvloop时替换默认事件循环；单个请求结果边执行边写入NDJSON
+    with open(results_path, "wb") as results_fp:
+        results = run_event_loop(parallel_execute_requests(
+            url=args.url,
+            prompt=args.prompt,
+            total_requests=args.requests,
+            max_workers=args.concurrency,
+            qps=args.qps,
+            batch_size=args.batch_size,
+            output_fp=results_fp
+        ))
     
     total_time = time.perf_counter() - start_time
     
@@ -150,11 +385,10 @@ def main():
         "prompt": args.prompt,
         "total_requests": args.requests,
         "max_workers": args.concurrency,
-        "jitter": args.jitter
+        "qps": args.qps,
+        "batch_size": args.batch_size
     }
-    report = generate_report(results, config)
-    report["summary"]["total_time"] = total_time
-    report["summary"]["throughput"] = args.requests / total_time
+    report = generate_report(results, config, total_time)
     
     # 打印摘要
     print("\n===== 压测结果摘要 =====")
@@ -168,13 +402,18 @@ def main():
         print(f"平均延迟: {report['summary']['avg_latency']:.3f}秒")
         print(f"最小延迟: {report['summary']['min_latency']:.3f}秒")
         print(f"最大延迟: {report['summary']['max_latency']:.3f}秒")
+        print(f"P50/P90/P95/P99/P99.9延迟: {report['summary']['p50_latency']:.3f}/"
+              f"{report['summary']['p90_latency']:.3f}/{report['summary']['p95_latency']:.3f}/"
+              f"{report['summary']['p99_latency']:.3f}/{report['summary']['p99.9_latency']:.3f}秒")
+        print(f"延迟抖动: {report['summary']['latency_jitter']:.3f}秒")
         print(f"Token速率: {report['summary']['tokens_per_second']:.1f} tokens/秒")
     
-    # 保存完整报告
-    with open(args.output, "w") as f:
-        json.dump(report, f, indent=2, ensure_ascii=False)
+    # 保存汇总报告
+    with open(args.output, "wb") as f:
+        f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
     
-    print(f"\n完整报告已保存至: {args.output}")
+    print(f"\n汇总报告已保存至: {args.output}")
+    print(f"单请求结果已保存至: {results_path}")
 
 if __name__ == "__main__":
     main()
@@ -15,9 +15,11 @@ server_process, port = launch_server_cmd(
     "python -m sglang.launch_server --model-path " + model + " --trust-remote-code --tp 1 --host 0.0.0.0 --port 30000"
 )
 
-# 添加重试机制
+# 添加重试机制：指数退避 + 随机抖动
+import random
 import time
 max_retries = 5
+delay = 0.25
 for i in range(max_retries):
     try:
         wait_for_server(f"http://localhost:{port}", timeout=120)
@@ -25,7 +27,8 @@ for i in range(max_retries):
     except Exception:
         if i == max_retries - 1:
             raise
-        time.sleep(10)
+        time.sleep(delay + random.uniform(0, delay))
+        delay = min(delay * 2, 10)
 
 set_default_backend(RuntimeEndpoint(f"http://localhost:{port}"))
 
@@ -35,9 +38,6 @@ def basic_qa(s, question):
     s += user(question)
     s += assistant(gen("answer", max_tokens=512))
 
-state = basic_qa("List 3 countries and their capitals.")
-print_highlight(state["answer"])
-
 
 @function
 def multi_turn_qa(s):
@@ -49,6 +49,15 @@ def multi_turn_qa(s):
     return s
 
 
-state = multi_turn_qa()
-print_highlight(state["first_answer"])
-print_highlight(state["second_answer"])
\ No newline at end of file
+# 两个生成互不依赖：在两个线程中分别执行阻塞的run()，请求同时到达服务端，
+# 由SGLang调度器一起批处理；result()返回时程序已执行完毕，变量均已生成
+from concurrent.futures import ThreadPoolExecutor
+with ThreadPoolExecutor(max_workers=2) as executor:
+    qa_future = executor.submit(basic_qa.run, "List 3 countries and their capitals.")
+    multi_turn_future = executor.submit(multi_turn_qa.run)
+    qa_state = qa_future.result()
+    multi_turn_state = multi_turn_future.result()
+
+print_highlight(qa_state["answer"])
+print_highlight(multi_turn_state["first_answer"])
+print_highlight(multi_turn_state["second_answer"])